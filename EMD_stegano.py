@@ -6,11 +6,41 @@
 # V2.1
 
 from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from functools import lru_cache, partial
+import numpy as np
 import argparse
-import math
+import tempfile
+import shutil
 import sys
 import os
 
+BYTE_LENGTH = 8
+SUFFIX_OUTPUT_FILE = '_EMD'
+# Hide and extract work on bands of this many image lines to bound the size of working copies
+BAND_LINES = 256
+# Numba (optional) is only loaded to hide at least this many digits, below that importing
+# and starting it costs more than the NumPy batch version takes
+NUMBA_MIN_DIGITS = 1 << 24
+# The (f, secret digit) actions table has (2n + 1)^2 entries, above this n the actions are computed from s
+ACTIONS_MAX_N = 64
+# bytes.translate() table : 1 for printable bytes, 0 otherwise
+# Bytes >= 0x80 are only parts of multi-byte UTF-8 characters, they are not counted
+_PRINTABLE_LUT = bytes(int(c < 0x80 and chr(c).isprintable()) for c in range(256))
+
+# Parameters of the (2n + 1)-ary system, computed once for each n : base, bits per digit and weights of f
+@lru_cache(maxsize=None)
+def emd_params(n: int) -> tuple:
+    base = 2 * n + 1
+    bits_per_digit = base.bit_length() - 1 # floor(log2(base))
+    # Weights of f, the smallest integer type holding the sum of n pixels at 255
+    max_sum = 255 * n * (n + 1) // 2
+    weights_type = next(t for t in (np.int16, np.int32, np.int64) if max_sum <= np.iinfo(t).max)
+    weights = np.arange(1, n + 1, dtype=weights_type)
+    weights.flags.writeable = False
+    return base, bits_per_digit, weights
+
 """
 Implementation of "Efficient Steganographic Embedding by Exploiting Modification Direction"
 IEEE COMMUNICATIONS LETTERS, VOL. 10, NO. 11, NOVEMBER 2006
@@ -24,8 +54,15 @@ Manage only grayscale image, if not convert it!
 """
 Class IMAGE 
 -----------
-    - Object = Pillow Image
-    - Pixels have coordinates (x,y)
+    - Object = pixels of an image opened with Pillow, the Pillow Image itself is not kept
+    - mode is the original mode of the image, width and height its size
+    - Pixels are held in arr, a NumPy uint8 array of shape (height, width)
+        - only the grayscale plane is kept, one byte per pixel
+        - arr is C-contiguous : a line of the image is width consecutive bytes
+        - a stego group is n consecutive bytes of a line, so groups are plain
+          slices of arr and a whole line of groups is a (width // n, n) view
+        - a color channel, if ever needed, should get its own plane like this one
+    - Pixels have coordinates (x,y) -> arr[y, x]
         - x is relative to the width axis 
         - y is relative to the height axis 
     - get_coord_xy is a function which returns coordinates x,y for a digit defined.
@@ -34,6 +71,7 @@ Class IMAGE
     - digit_index is the index in digits which are the conversion of SECRET to be hidden in numbers
         As a digit is coded in n pixels, the n-th digit position could be calculated -> get_coord_xy()
     - stego_group is a group of n pixels hiding one bit of SECRET
+    - get_stego_groups returns stego groups start..start+nb_groups of the image as a (nb_groups, n) array
 
 """
 class IMAGE:
@@ -42,38 +80,48 @@ class IMAGE:
             img = Image.open(image_path)
         except Exception:
             print(f"\x1b[1;91m❌\x1b[0m \x1b[96mNot an image file !\x1b[0m")
-        self.img = img
+        # Original mode is kept to warn about the conversion in grayscale
         self.mode = img.mode
-        self.pixels = img.load()
         self.width, self.height = img.size
+        with img:
+            gray = img if img.mode == 'L' else img.convert('L')
+            # Grayscale pixels copied once from tobytes() in a writable buffer, arr is the only copy kept
+            self.arr = np.frombuffer(bytearray(gray.tobytes()), dtype=np.uint8).reshape(self.height, self.width)
+            gray.close()
+
+    # Pixels left at the end of a line (width % n) are not used
+    def check_stego_groups(self, n: int, nb_groups: int) -> None:
+        available = (self.width // n) * self.height
+        if available < nb_groups:
+            raise ValueError(f"\x1b[1;91m❌\x1b[0mImage too small : {available} stego groups available, {nb_groups} required !\x1b[0m")
+
+    # Stego groups start..start+nb_groups as a (nb_groups, n) array, in the same order as get_xy()
+    # Only the lines holding them are read
+    # The result is always C-contiguous : a view on whole lines when width is a multiple of n,
+    # a copy of the cropped lines otherwise, so the kernels see a single layout
+    def get_stego_groups(self, n: int, nb_groups: int, start: int = 0) -> np.ndarray:
+        self.check_stego_groups(n, start + nb_groups)
+        line = self.width // n
+        first_line, last_line = start // line, -(-(start + nb_groups) // line)
+        groups = self.arr[first_line:last_line, : line * n].reshape(-1, n)
+        offset = start - first_line * line
+        return groups[offset : offset + nb_groups]
+
+    # Write back stego groups returned by get_stego_groups()
+    # Nothing to do when they are a view on arr (width is a multiple of n), already modified in place
+    def set_stego_groups(self, n: int, groups: np.ndarray, start: int = 0) -> None:
+        if np.may_share_memory(groups, self.arr):
+            return
+        line = self.width // n
+        lines = self.arr[:, : line * n].reshape(self.height, line, n)
+        y, x = np.divmod(np.arange(start, start + len(groups)), line)
+        lines[y, x] = groups
 
-    # Extract and calculate digits from IMAGE 
-    def get_digits(self, n: int, length: int) -> list:
-        base = 2 * n + 1
-        bits_per_digit = math.floor(math.log2(base))
-
-        digits = []
-        nb_digits = math.ceil(length * BYTE_LENGTH / bits_per_digit)
-        for index in range(nb_digits):
-            Sg = STEGO_GROUP(self,index,n)
-            digits.append(Sg.get_digit())
-            if options.verbose:
-                print(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m For Stego group {index} : p = {Sg.pixels} and f(p) = {Sg.get_digit().value} \x1b[0m")
-        if options.debug or options.verbose:
-            print(f"\x1b[1m[\x1b[93m+\x1b[0m\x1b[1m]\x1b[0m Get {len(Sg.pixels)} digits from image\x1b[0m")
-        return digits
-
-    def convert_grayscale(self) -> None:
-        self.img = self.img.convert("L")
-        
     def get_nb_pixels(self) -> int:
         return self.width*self.height
 
-    def set_pixel(self, x: int, y: int, value: int) -> None:
-        self.pixels[x, y] = value
-
     def save(self, image_output_path: str) -> None:
-        self.img.save(image_output_path)
+        Image.fromarray(self.arr).save(image_output_path)
 
     def get_xy(self, index: int, n: int) -> list:
         line = self.width // n
@@ -81,22 +129,6 @@ class IMAGE:
         x = (index % line) * n
         return x, y
 
-"""
-Class DIGIT
------------
-    - Dgit is a number in base (2n + 1)
-    - One digit contains bits_per_digit (= math.floor(math.log2(base))) bits
-"""
-class DIGIT:
-    def __init__(self, n: int, value: int) -> None:
-        self.n = n
-        self.base = 2 * n + 1
-        self.bits_per_digit = math.floor(math.log2(self.base))
-        self.value = value
-    
-    def convert_to_bits(self):
-        return bin(self.value)[2:].zfill(int(self.bits_per_digit))
-
 """
 Class STEGO_GROUP
 -----------
@@ -110,29 +142,18 @@ class STEGO_GROUP:
         self.index = index
         self.image = image
         self.n = size
-        self.base = 2 * self.n + 1
+        self.base, _, self.weights = emd_params(size)
         self.x, self.y = self.image.get_xy(self.index, self.n)
         self.pixels = self.get_pixels()
 
-    def get_pixels(self) -> list:
-        p = [self.image.pixels[self.x + i, self.y] for i in range(self.n)]
-        return p
-
-    def set_pixels(self, new_values: list) -> None:
-        try:
-            for i in range(self.n):
-                self.image.set_pixel(self.x + i, self.y, new_values[i])
-        except Exception as e:
-            print(f"\x1b[1;91m❌\x1b[0m \x1b[96mChange pixel values error -> {type(e)} : {e}\x1b[0m")
+    # View on the n pixels of the group (not a copy) : changing it changes the image
+    def get_pixels(self) -> np.ndarray:
+        return self.image.arr[self.y, self.x : self.x + self.n]
 
     # Calulation of f as a weighted sum modulo (2n + 1) 
     # f(g1, g2,...,gn) = SUM[(gi*i)] mod (2n + 1) for i = 1..n
-    def get_digit(self) -> DIGIT:
-        weighted_sum = 0
-        for i in range(self.n):
-            weighted_sum += (i + 1) * self.pixels[i]
-        Digit = DIGIT(self.n, weighted_sum % self.base)
-        return Digit
+    def get_digit(self) -> int:
+        return int(self.pixels @ self.weights) % self.base
 
 """
 Class SECRET
@@ -145,71 +166,138 @@ class SECRET:
     def __init__(self, data, n) -> None:
         self.length = len(data)
         self.n = n
-        self.base = 2 * self.n + 1
-        self.bits_per_digit = math.floor(math.log2(self.base))
+        self.base, self.bits_per_digit, _ = emd_params(n)
+        # Weights of the bits of a digit, most significant first
+        self.pow2 = 1 << np.arange(self.bits_per_digit - 1, -1, -1)
 
         #Manage format inputs
-        if isinstance(data, str): 
-            self.bytes = data.encode('utf-8')
-        elif all(isinstance(x, int) and x in (0, 1) for x in data): #Array of bits
-            self.bytes = []
-            for i in range(0, len(data), BYTE_LENGTH):
-                byte = data[ i : i + BYTE_LENGTH]
-                self.bytes.append(int(''.join(str(bit) for bit in byte), 2))
-            self.bytes = bytes(self.bytes)
-        else:
-            self.bytes = data
+        if isinstance(data, (list, np.ndarray)): #Array of bits, kept as they are for the complete bytes
+            self.bytes = self.bits_to_bytes(data)
+            self.bits = np.asarray(data[: len(self.bytes) * BYTE_LENGTH], dtype=np.uint8)
+        else: #String or bytes read from a file, unpacked straight from their buffer
+            self.bytes = data.encode('utf-8') if isinstance(data, str) else data
+            self.bits = self.bytes_to_bits()
+
+    def bytes_to_bits(self) -> np.ndarray:
+        return np.unpackbits(np.frombuffer(self.bytes, dtype=np.uint8))
+
+    # Incomplete last byte is dropped
+    def bits_to_bytes(self, bit_list) -> bytes:
+        num_bytes = len(bit_list) // BYTE_LENGTH
+        return np.packbits(np.asarray(bit_list[: num_bytes * BYTE_LENGTH], dtype=np.uint8)).tobytes()
+
+    #Convert bits to digits in a (2n + 1)-ary notational system, returned as an array of values
+    def get_digits(self, n: int) -> np.ndarray:
+        verbose = options.verbose
+        debug = options.debug or verbose
+        # Manage the case : Secret bits number is not exactly the number of digits * self.bits_per_digit
+        padding = -len(self.bits) % self.bits_per_digit
+        groups = np.pad(self.bits, (0, padding)).reshape(-1, self.bits_per_digit)
+        values = groups @ self.pow2
+        if verbose:
+            sys.stdout.writelines(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m For group of bits {group.tolist()} in Secret bitstream, digit is {value}\x1b[0m\n" for group, value in zip(groups, values))
+        if debug:
+            print(f"\x1b[1m[\x1b[93m+\x1b[0m\x1b[1m]\x1b[0m Convert {len(values)} digits from Secret bitstream of length {len(self.bits)}\x1b[0m")
+        return values
 
-        self.bits = self.bytes_to_bits()
+    def __str__(self) -> str:
+        return f"{self.bytes}"
 
-    def bytes_to_bits(self) -> list:
-        bit_list = []
-        for char in self.bytes:
-            bit_list.extend([int(b) for b in bin(char)[2:].zfill(BYTE_LENGTH)])
-        return bit_list
+"""
+Search of printable text
+-----------
+    - raw_bytes is read again with a shift of 0 to 7 bits, the secret may not start on a byte
+    - Returns the first substring of length bytes with at least tolerance printable bytes,
+      its offset and the bit shift, or None
+"""
+def find_printable_substring(raw_bytes: bytes, length: int, tolerance = 0.90) -> tuple:
+    nb_bytes = len(raw_bytes)
+    value = int.from_bytes(raw_bytes, 'big')
+    for b in range(BYTE_LENGTH):
+        # Only full bytes are kept after a shift
+        shifted_bytes = raw_bytes if b == 0 else ((value << b) & ((1 << nb_bytes * BYTE_LENGTH) - 1)).to_bytes(nb_bytes, 'big')[:-1]
+        if len(shifted_bytes) < length:
+            continue
+        # Printable count of every window of length bytes, from a cumulative sum
+        printable = np.frombuffer(shifted_bytes.translate(_PRINTABLE_LUT), dtype=np.uint8)
+        cumsum = np.concatenate(([0], np.cumsum(printable)))
+        printable_counts = cumsum[length:] - cumsum[:-length]
+        # argmax stops at the first window reaching tolerance, no list of all hits is built
+        found = printable_counts / length >= tolerance
+        i = int(found.argmax())
+        if found[i]:
+            return (shifted_bytes[i:i + length],i,b)
+    return None
 
-    def bits_to_bytes(self, bit_list: list) -> bytes:
-        num_bytes = len(bit_list) // BYTE_LENGTH
-        byte_values = []
-        for i in range(num_bytes):
-            byte_bits = bit_list[i*BYTE_LENGTH : (i+1)*BYTE_LENGTH]
-            binary_string = "".join(str(b) for b in byte_bits)
-            decimal_value = int(binary_string, 2)
-            byte_values.append(decimal_value)
-        return bytes(byte_values)
-
-    #Convert bits to digits in a (2n + 1)-ary notational system
-    def get_digits(self, n: int) -> list:
-        digits = []
-        for i in range(0, len(self.bits), self.bits_per_digit):
-            group = self.bits[i : i + self.bits_per_digit]
-
-            # Manage the case : Secret bits number is not exactly the number of digits * self.bits_per_digit
-            if len(group) < self.bits_per_digit:
-                group.extend([0] * (self.bits_per_digit - len(group)))
-
-            value = int(''.join(map(str, group)),2) 
-            if options.verbose:
-                print(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m For group of bits {group} in Secret bitstream, digit is {value}\x1b[0m")
-            Digit = DIGIT(n, value)
-            digits.append(Digit)
-        if options.debug or options.verbose:
-            print(f"\x1b[1m[\x1b[93m+\x1b[0m\x1b[1m]\x1b[0m Convert {len(digits)} digits from Secret bitstream of length {len(self.bits)}\x1b[0m")
-        return digits
-
-    def find_printable_substring(self, length: int, tolerance = 0.90) -> list: 
-        for b in range(BYTE_LENGTH):
-            raw_bytes = self.bits_to_bytes(self.bits[b:])
-            for i in range(len(raw_bytes) - length + 1):
-                substring_bytes = raw_bytes[i:i + length]
-                decoded_substring = substring_bytes.decode('utf-8', errors='ignore')
-                printable_count = sum(1 for char in decoded_substring if char.isprintable())
-                if (printable_count / length) >= tolerance:
-                    return (substring_bytes,i,b)
+"""
+Embedding kernels compiled with Numba
+-----------
+    - Same modification as EMD.embed() for each of the stego groups, in place
+    - groups is a (nb_groups, n) uint8 array and digits the secret digits to hide
+    - Only used to hide NUMBA_MIN_DIGITS digits or more, smaller secrets use EMD.embed_batch()
+    - n = 2 (base 5) is the default and gets its own kernel : the pixel and the
+      direction to change are read in _ACTIONS_N2[f * 5 + secret digit]
+"""
+# Pixel to change and direction at index f * (2n + 1) + secret digit, (0, 0) when nothing changes
+# Same rule as EMD.embed() : pixel s-1 is increased if s <= n, pixel (2n+1)-s-1 is decreased otherwise
+# Built once for each n, only for n <= ACTIONS_MAX_N
+@lru_cache(maxsize=None)
+def _actions_table(n: int) -> np.ndarray:
+    base = 2 * n + 1
+    s = (np.arange(base)[None, :] - np.arange(base)[:, None]) % base
+    pos = np.where(s == 0, 0, np.where(s <= n, s - 1, base - s - 1))
+    delta = np.where(s == 0, 0, np.where(s <= n, 1, -1))
+    actions = np.stack((pos, delta), axis=-1).reshape(-1, 2).astype(np.int8)
+    actions.flags.writeable = False
+    return actions
+
+_ACTIONS_N2 = _actions_table(2)
+
+# Numba is imported and the kernels are defined on first use only, None without Numba
+# Groups are independent from each other, kernels spread them over threads with prange
+@lru_cache(maxsize=None)
+def _numba_kernels() -> tuple | None:
+    try:
+        from numba import njit, prange
+    except ImportError:
         return None
 
-    def __str__(self) -> str:
-        return f"{self.bytes}"
+    @njit(cache=True)
+    def _embed_row(groups, row, digit, n, base):
+        f = 0
+        for i in range(n):
+            f += (i + 1) * groups[row, i]
+        s = (digit - f) % base
+        while s != 0:
+            if s <= n:
+                pos = s - 1
+                delta = -1 if groups[row, pos] == 255 else 1
+            else:
+                pos = base - s - 1
+                delta = 1 if groups[row, pos] == 0 else -1
+            groups[row, pos] += delta
+            s = (s - delta * (pos + 1)) % base
+
+    @njit(parallel=True, cache=True)
+    def _embed_kernel(groups, digits, n, base):
+        for row in prange(groups.shape[0]):
+            _embed_row(groups, row, digits[row], n, base)
+
+    # A pixel stuck at 0 or 255 sends its group to the generic row embedding
+    @njit(parallel=True, cache=True)
+    def _embed_kernel_n2(groups, digits):
+        for row in prange(groups.shape[0]):
+            f = (groups[row, 0] + 2 * groups[row, 1]) % 5
+            pos = _ACTIONS_N2[f * 5 + digits[row], 0]
+            delta = _ACTIONS_N2[f * 5 + digits[row], 1]
+            if delta != 0:
+                pixel = groups[row, pos] + delta
+                if 0 <= pixel <= 255:
+                    groups[row, pos] = pixel
+                else:
+                    _embed_row(groups, row, digits[row], 2, 5)
+
+    return _embed_kernel, _embed_kernel_n2
 
 """
 Class EMD
@@ -231,97 +319,176 @@ Class EMD
 class EMD:
     def __init__(self, n: int) -> None:
         self.n = n
-        self.base = 2 * n + 1
-        self.bits_per_digit = math.floor(math.log2(self.base))
+        self.base, self.bits_per_digit, self.weights = emd_params(n)
+        # Shifts to read the bits of a digit, most significant first
+        self.bit_shifts = np.arange(self.bits_per_digit - 1, -1, -1)
         if options.debug or options.verbose:
             print(f"\x1b[1m[\x1b[93m+\x1b[0m\x1b[1m]\x1b[0m n = {self.n}, base (2n+1) = {self.base}, bits per digit = {self.bits_per_digit}\x1b[0m")
 
+    # Calculation of f for all stego groups at once, groups is a (nb_groups, n) array
+    # f(g1, g2,...,gn) = SUM[(gi*i)] mod (2n + 1) for i = 1..n
+    def f_batch(self, groups: np.ndarray) -> np.ndarray:
+        return (groups.astype(self.weights.dtype) @ self.weights) % self.base
 
     #Modify the correct pixel by incrementing or decrementing of 1 
-    #Manage the cases of pixel values = 0 or 255
-    def embed(self, Sg: STEGO_GROUP, secret_digit: DIGIT) -> STEGO_GROUP:
-        if options.verbose:
-            print(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m For stego group number {Sg.index:4d} list of pixels = = = = = = = = = = = = = = = = = = = = {Sg.pixels} -> f = {Sg.get_digit().value:4d}\x1b[0m")
-
-        new_Sg = Sg
-
-        if new_Sg.get_digit().value != secret_digit.value:
-            s = (secret_digit.value - new_Sg.get_digit().value) % self.base
+    #Manage the cases of pixel values = 0 or 255 : the pixel is moved the other way
+    #and s is updated from the weight of the pixel, until the secret digit is reached
+    #pixels are the n pixels of a stego group, a view on the image which is modified in place
+    #f of the stego group can be given when the caller already knows it
+    #Returns the initial s, 0 when the stego group already hides the secret digit
+    def embed(self, pixels: np.ndarray, secret_digit: int, f: int | None = None) -> int:
+        if f is None:
+            f = int(pixels @ self.weights) % self.base
+        first_s = s = (secret_digit - f) % self.base
+        while s != 0:
             if s <= self.n:
-                pos = s - 1 
-                pixel_to_change = new_Sg.pixels[pos]
-                if pixel_to_change == 255:
-                    new_Sg.pixels[pos] -= 1
-                    new_Sg = self.embed(new_Sg, secret_digit)
-                else:
-                    new_Sg.pixels[pos] = pixel_to_change + 1
-            elif s > self.n:
+                pos = s - 1
+                delta = -1 if pixels[pos] == 255 else 1
+            else:
                 pos = self.base - s - 1
-                pixel_to_change = new_Sg.pixels[pos]
-                if pixel_to_change == 0:
-                    new_Sg.pixels[pos] += 1
-                    new_Sg = self.embed(new_Sg, secret_digit)
-                else:
-                    new_Sg.pixels[pos] = pixel_to_change - 1
-            if options.verbose:
-                print(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m    s = {s:6d} so digit {new_Sg.index:4d} changed and to embed secret digit {secret_digit.value:4d} now is equal to {new_Sg.pixels} -> f = {new_Sg.get_digit().value:4d}\x1b[0m")
+                delta = 1 if pixels[pos] == 0 else -1
+            pixels[pos] = int(pixels[pos]) + delta
+            s = (s - delta * (pos + 1)) % self.base
+        return first_s
+
+    # Same modification as embed() for all stego groups at once, groups is modified in place
+    # The pixel and direction of each group are read in a (f, secret digit) table for small n,
+    # computed from s = (secret digit - f) mod (2n + 1) otherwise
+    # Groups whose pixel was stuck at 0 or 255 are moved the other way, then processed again
+    # The table is looked up here and not in __init__, search creates an EMD for each n without hiding
+    def embed_batch(self, groups: np.ndarray, digits: np.ndarray) -> None:
+        actions = _actions_table(self.n) if self.n <= ACTIONS_MAX_N else None
+        rows = np.arange(len(groups))
+        while rows.size:
+            f = self.f_batch(groups[rows])
+            if actions is not None:
+                moves = actions[f * self.base + digits[rows]]
+                pos, delta = moves[:, 0], moves[:, 1]
+            else:
+                s = (digits[rows] - f) % self.base
+                pos = np.where(s <= self.n, s - 1, self.base - s - 1)
+                delta = np.where(s == 0, 0, np.where(s <= self.n, 1, -1))
+            changed = delta != 0
+            rows, pos, delta = rows[changed], pos[changed], delta[changed]
+            pixels = groups[rows, pos].astype(np.int32)
+            saturated = (pixels + delta < 0) | (pixels + delta > 255)
+            groups[rows, pos] = np.where(saturated, pixels - delta, pixels + delta)
+            rows = rows[saturated]
+
+    # Fastest available embedding of digits in groups, in place
+    # Numba kernels are used only when asked for, hide asks for them for large secrets
+    def embed_groups(self, groups: np.ndarray, digits: np.ndarray, use_numba: bool = False) -> None:
+        kernels = _numba_kernels() if use_numba else None
+        if kernels is None:
+            self.embed_batch(groups, digits)
+        elif self.n == 2:
+            kernels[1](groups, digits)
         else:
-            if options.verbose:
-                print(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m    s = 0      so digit {new_Sg.index:4d} do not change\x1b[0m")
-
-        return new_Sg
+            kernels[0](groups, digits, self.n, self.base)
 
     # Hide each byte of data in image
     def hide(self, Secret: SECRET, Img: IMAGE) -> IMAGE:
-        if options.debug or options.verbose:
+        # Options are read once, the checks below are on local booleans
+        verbose = options.verbose
+        debug = options.debug or verbose
+        if debug:
             print(f"\x1b[1m[\x1b[93m+\x1b[0m\x1b[1m]\x1b[0m Secret to hide : {len(Secret.bytes)} bytes and {len(Secret.bits)} bits\x1b[0m")
-        if options.verbose:
+        if verbose:
             print(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m Secret bytes to hide is {Secret.bytes}\x1b[0m")
-            print(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m Secret bits to hide is {Secret.bits}\x1b[0m")
+            print(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m Secret bits to hide is {Secret.bits.tolist()}\x1b[0m")
             
-        required_digits = math.ceil(len(Secret.bits) / self.bits_per_digit)
-        if options.debug or options.verbose:
+        required_digits = -(-len(Secret.bits) // self.bits_per_digit)
+        if debug:
             print(f"\x1b[1m[\x1b[93m+\x1b[0m\x1b[1m]\x1b[0m Required digits (stego_group) to hide Secret : {required_digits}\x1b[0m")
 
-        if Img.width * Img.height < required_digits * self.n:
-            raise ValueError(f"\x1b[1;91m❌\x1b[0mImage too small : {Img.width * Img.height} pixels available, {required_digits * n} required !\x1b[0m")
+        Img.check_stego_groups(self.n, required_digits)
 
         Secret_digits = Secret.get_digits(self.n)
-        if options.verbose:
-            print(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m List of {len(Secret_digits)} digits {self.base}-ary to hide are : {[digit.value for digit in Secret_digits]}\x1b[0m")
-
-        for index in range(len(Secret_digits)):
-            Sg = STEGO_GROUP(Img, index, self.n)
-            new_Sg = self.embed(Sg, Secret_digits[index])
-            Sg.set_pixels(new_Sg.pixels)
+        if verbose:
+            print(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m List of {len(Secret_digits)} digits {self.base}-ary to hide are : {Secret_digits.tolist()}\x1b[0m")
+
+        if verbose:
+            # Trace lines are streamed to the buffered stdout, they are never all held in memory
+            write = sys.stdout.write
+            for index in range(len(Secret_digits)):
+                Sg = STEGO_GROUP(Img, index, self.n)
+                secret_digit = int(Secret_digits[index])
+                f = Sg.get_digit()
+                write(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m For stego group number {Sg.index:4d} list of pixels = = = = = = = = = = = = = = = = = = = = {Sg.pixels.tolist()} -> f = {f:4d}\x1b[0m\n")
+                s = self.embed(Sg.pixels, secret_digit, f)
+                if s != 0:
+                    write(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m    s = {s:6d} so digit {Sg.index:4d} changed and to embed secret digit {secret_digit:4d} now is equal to {Sg.pixels.tolist()} -> f = {Sg.get_digit():4d}\x1b[0m\n")
+                else:
+                    write(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m    s = 0      so digit {Sg.index:4d} do not change\x1b[0m\n")
+        else:
+            band = max(1, BAND_LINES * (Img.width // self.n))
+            use_numba = required_digits >= NUMBA_MIN_DIGITS
+            for start in range(0, required_digits, band):
+                groups = Img.get_stego_groups(self.n, min(band, required_digits - start), start)
+                self.embed_groups(groups, Secret_digits[start : start + band], use_numba)
+                Img.set_stego_groups(self.n, groups, start)
 
         print(f"\x1b[1;92m✅\x1b[0m \x1b[96mSecret of {Secret.length} bytes hidden with {len(Secret_digits)} digits of base {self.base} and {len(Secret.bits)} bits\x1b[0m")
         return Img
 
-    def extract(self, Img: IMAGE, data_length: int) -> bytes:
-        Img_digits = Img.get_digits(self.n, data_length)
-
-        bits = []
-        for digit in Img_digits:
-            binary = digit.convert_to_bits()
-            bits.extend([int(b) for b in binary])
-            if options.verbose:
-                print(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m  Converting digit = {digit.value:4d} to bits = {binary}\x1b[0m")
+    # With raw, extracted bytes are returned as they are instead of a SECRET
+    def extract(self, Img: IMAGE, data_length: int, raw: bool = False) -> SECRET | bytes:
+        verbose = options.verbose
+        debug = options.debug or verbose
+        nb_digits = -(-data_length * BYTE_LENGTH // self.bits_per_digit)
+        Img.check_stego_groups(self.n, nb_digits)
+        band = max(1, BAND_LINES * (Img.width // self.n))
+        values = np.empty(nb_digits, dtype=self.weights.dtype)
+        digit_bits = np.empty((nb_digits, self.bits_per_digit), dtype=np.uint8)
+        for start in range(0, nb_digits, band):
+            groups = Img.get_stego_groups(self.n, min(band, nb_digits - start), start)
+            band_values = self.f_batch(groups)
+            values[start : start + band] = band_values
+            if verbose:
+                sys.stdout.writelines(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m For Stego group {index} : p = {group.tolist()} and f(p) = {value} \x1b[0m\n" for index, (group, value) in enumerate(zip(groups, band_values), start))
+            # Each digit gives its bits_per_digit lowest bits, most significant first
+            if self.bits_per_digit <= BYTE_LENGTH:
+                digit_bits[start : start + band] = np.unpackbits(band_values.astype(np.uint8)[:, None], axis=1)[:, BYTE_LENGTH - self.bits_per_digit :]
+            else:
+                digit_bits[start : start + band] = (band_values[:, None] >> self.bit_shifts) & 1
+        if debug:
+            print(f"\x1b[1m[\x1b[93m+\x1b[0m\x1b[1m]\x1b[0m Get {nb_digits} digits from image\x1b[0m")
+
+        if verbose:
+            sys.stdout.writelines(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m  Converting digit = {value:4d} to bits = {''.join(map(str, binary.tolist()))}\x1b[0m\n" for value, binary in zip(values, digit_bits))
         #Keep the exact quantity of bits...
-        bits = bits[:data_length * BYTE_LENGTH]
+        bits = digit_bits.ravel()[:data_length * BYTE_LENGTH]
 
-        if options.debug or options.verbose:
-            print(f"\x1b[1m[\x1b[93m+\x1b[0m\x1b[1m]\x1b[0m Converted {len(bits)} bits from {len(Img_digits)} digits\x1b[0m")
+        if debug:
+            print(f"\x1b[1m[\x1b[93m+\x1b[0m\x1b[1m]\x1b[0m Converted {len(bits)} bits from {len(values)} digits\x1b[0m")
 
-        if options.verbose:
-            print(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m numbers {self.base}-ary extracted : {[digit.value for digit in Img_digits]}\x1b[0m")
+        if verbose:
+            print(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m numbers {self.base}-ary extracted : {values.tolist()}\x1b[0m")
             print(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m Extracted Message in {len(bits)} bits\x1b[0m")
-            print(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m bits of Secret = {bits}\x1b[0m")
-        Secret = SECRET(bits, self.n)
-
-        if options.debug or options.verbose:
-            print(f"\x1b[1m[\x1b[93m+\x1b[0m\x1b[1m]\x1b[0m Extracted {Secret.length // BYTE_LENGTH} bytes from image\x1b[0m")
-        return Secret
+            print(f"\x1b[1m[\x1b[93m++\x1b[0m\x1b[1m]\x1b[0m bits of Secret = {bits.tolist()}\x1b[0m")
+        if debug:
+            print(f"\x1b[1m[\x1b[93m+\x1b[0m\x1b[1m]\x1b[0m Extracted {len(bits) // BYTE_LENGTH} bytes from image\x1b[0m")
+        if raw:
+            return np.packbits(bits).tobytes()
+        return SECRET(bits, self.n)
+
+# Search is spread over processes, one value of n per task
+# Each worker opens the image once and gets the options of the main process
+# With -v/-vv, traces of a task go to a temporary file returned with its result,
+# the main process copies them to stdout in order of n and removes the file
+def _init_search_worker(main_options: argparse.Namespace, image_path: str) -> None:
+    global options, search_image
+    options = main_options
+    search_image = IMAGE(image_path)
+
+def _search_one(n: int, length: int) -> tuple:
+    nb_bytes_max = (search_image.get_nb_pixels() // BYTE_LENGTH // n)
+    if not (options.debug or options.verbose):
+        bytes_candidate = EMD(n).extract(search_image, nb_bytes_max, raw=True)
+        return find_printable_substring(bytes_candidate, length), None
+    with tempfile.NamedTemporaryFile("w", prefix="EMD_search_", suffix=".log", delete=False) as trace, redirect_stdout(trace):
+        bytes_candidate = EMD(n).extract(search_image, nb_bytes_max, raw=True)
+    return find_printable_substring(bytes_candidate, length), trace.name
 
 def parseArgs() -> dict:
     parser = argparse.ArgumentParser(add_help=True, description="The EMD_Stegano script allows you to hide SECRET in an image or read hidden SECRET from an image with a Steganographic process called EMD (Exploiting Modification Direction)")
@@ -370,9 +537,6 @@ def header() -> None:
 """)
 
 if __name__ == '__main__':
-    BYTE_LENGTH = 8
-    SUFFIX_OUTPUT_FILE = '_EMD'
- 
     header()
     options = parseArgs()
 
@@ -425,16 +589,17 @@ if __name__ == '__main__':
             case 'search':
                 Img_steg = IMAGE(options.input_image)
                 n_max = Img_steg.width - 1 #Should be different...
-                for n in range(2,n_max):
-                    nb_bytes_max = (Img_steg.get_nb_pixels() // BYTE_LENGTH // n)
-                    if options.debug or options.verbose:
-                        print(f"\x1b[1m[\x1b[93m+\x1b[0m\x1b[1m]\x1b[0m Searching text with {n = }/{n_max}\x1b[0m")
-                    Steg = EMD(n)
-                    bytes_candidate = Steg.extract(Img_steg, nb_bytes_max)
-                    result = bytes_candidate.find_printable_substring(options.length)
-                    if result is not None:
-                        (bytes_printable, offset, bit_shift) = result
-                        print(f"\x1b[1;92m✅\x1b[0m \x1b[96mFound = {bytes_printable} with {n = }, {offset = }, {bit_shift = }\x1b[0m")
+                with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_search_worker, initargs=(options, options.input_image)) as executor:
+                    results = executor.map(partial(_search_one, length=options.length), range(2,n_max))
+                    for n, (result, trace) in zip(range(2,n_max), results):
+                        if options.debug or options.verbose:
+                            print(f"\x1b[1m[\x1b[93m+\x1b[0m\x1b[1m]\x1b[0m Searching text with {n = }/{n_max}\x1b[0m")
+                            with open(trace) as file:
+                                shutil.copyfileobj(file, sys.stdout)
+                            os.remove(trace)
+                        if result is not None:
+                            (bytes_printable, offset, bit_shift) = result
+                            print(f"\x1b[1;92m✅\x1b[0m \x1b[96mFound = {bytes_printable} with {n = }, {offset = }, {bit_shift = }\x1b[0m")
 
             case _:
                 parser.print_help()